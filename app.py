@@ -1,10 +1,18 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import psycopg
+from psycopg_pool import ConnectionPool
+from config import CFG
 import pandas as pd
-from datetime import datetime, timedelta
+import numpy as np
+from datetime import datetime, date, time as dt_time, timedelta
+import io
+import logging
+import threading
 import time
-import os
-from typing import List, Dict, Any
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 
 # Page configuration
 st.set_page_config(
@@ -14,189 +22,320 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Bulk inserts with more rows than this use COPY instead of executemany
+BULK_COPY_THRESHOLD = 500
+
+# Rows fetched per round trip when exporting payments from a server-side cursor
+STREAM_CHUNK_SIZE = 2000
+
+# Cached reads roll over every CACHE_TTL seconds. Once payments_ch
+# notifications are confirmed to arrive, writes and notifications invalidate
+# them instead and NOTIFY_CACHE_TTL only bounds staleness
+CACHE_TTL = 5
+NOTIFY_CACHE_TTL = 60
+
+logger = logging.getLogger(__name__)
+
 # Database connection
+def connection_kwargs() -> Dict[str, Optional[str]]:
+    """Connection parameters for Neon"""
+    return {
+        "host": CFG.host,
+        "dbname": CFG.database,
+        "user": CFG.user,
+        "password": CFG.password,
+        "port": CFG.port,
+        "sslmode": "require",
+    }
+
 @st.cache_resource
-def init_connection():
-    """Initialize database connection to Neon"""
+def get_pool():
+    """Initialize a connection pool to Neon, shared by all sessions"""
+    pool = None
     try:
-        connection = psycopg2.connect(
-            host=os.getenv("NEON_HOST"),
-            database=os.getenv("NEON_DATABASE"),
-            user=os.getenv("NEON_USER"),
-            password=os.getenv("NEON_PASSWORD"),
-            port=os.getenv("NEON_PORT", "5432"),
-            sslmode="require"
+        pool = ConnectionPool(
+            min_size=1,
+            max_size=10,
+            kwargs=connection_kwargs(),
+            # Neon closes idle connections; check them before handing out
+            check=ConnectionPool.check_connection,
+            open=True,
         )
-        return connection
+        pool.wait(timeout=10)
+        return pool
     except Exception as e:
+        # Stop the pool's background workers from retrying forever
+        if pool is not None:
+            pool.close()
         st.error(f"Failed to connect to database: {e}")
         return None
 
-def get_payments(conn, limit: int = 100) -> List[Dict[Any, Any]]:
-    """Fetch recent payments from database"""
-    if not conn:
-        return []
-    
-    try:
-        cursor = conn.cursor()
+# Queries pass prepare=True so each pooled connection parses and plans them
+# once, then reuses the server-side prepared statement on later calls
+@contextmanager
+def get_conn():
+    """Borrow a connection from the pool and return it when done"""
+    with get_pool().connection() as conn:
+        yield conn
+
+@st.cache_data(ttl=NOTIFY_CACHE_TTL, max_entries=32, show_spinner=False)
+def load_payments(limit: int = 100,
+                  before: Optional[Tuple[datetime, int]] = None,
+                  epoch: int = 0) -> pd.DataFrame:
+    """Query recent payments; errors propagate so a failure is never cached"""
+    # epoch only keys the cache; see cache_epoch
+    # Keyset pagination: seek past the cursor on the (created_at, id)
+    # index rather than scanning and discarding rows with OFFSET
+    if before is None:
+        query = """
+        SELECT id, customer_name, amount, currency, status, payment_method, 
+               created_at
+        FROM payments 
+        ORDER BY created_at DESC, id DESC 
+        LIMIT %s
+        """
+        params = (limit,)
+    else:
         query = """
         SELECT id, customer_name, amount, currency, status, payment_method, 
-               created_at, updated_at
+               created_at
         FROM payments 
-        ORDER BY created_at DESC 
+        WHERE (created_at, id) < (%s, %s)
+        ORDER BY created_at DESC, id DESC 
         LIMIT %s
         """
-        cursor.execute(query, (limit,))
+        params = (*before, limit)
+    
+    with get_conn() as conn, conn.cursor() as cursor:
+        cursor.execute(query, params, prepare=True)
         columns = [desc[0] for desc in cursor.description]
-        payments = [dict(zip(columns, row)) for row in cursor.fetchall()]
-        cursor.close()
-        return payments
+        payments = pd.DataFrame(cursor.fetchall(), columns=columns)
+    # NUMERIC arrives as Decimal objects; store amounts as an Arrow float column
+    payments['amount'] = pd.to_numeric(payments['amount']).astype("float64[pyarrow]")
+    return payments
+
+def export_payments_csv(chunk_size: int = STREAM_CHUNK_SIZE) -> bytes:
+    """Export all payments as CSV, newest first"""
+    query = """
+    SELECT id, customer_name, amount, currency, status, payment_method, 
+           created_at
+    FROM payments 
+    ORDER BY created_at DESC, id DESC
+    """
+    buffer = io.StringIO()
+    # Rows stream from a server-side cursor and are written out one chunk at
+    # a time, so only the CSV text and a single chunk are held in memory
+    with get_conn() as conn, conn.cursor(name="payments_export") as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(query)
+        columns = [desc[0] for desc in cursor.description]
+        buffer.write(",".join(columns) + "\n")
+        while rows := cursor.fetchmany(chunk_size):
+            pd.DataFrame(rows, columns=columns).to_csv(buffer, header=False, index=False)
+    return buffer.getvalue().encode()
+
+def add_payment(customer_name: str, amount: float, currency: str, 
+                payment_method: str) -> Optional[Dict[str, Any]]:
+    """Add a new payment to the database and return the inserted row"""
+    try:
+        with get_conn() as conn, conn.cursor() as cursor:
+            query = """
+            INSERT INTO payments (customer_name, amount, currency, status, payment_method, created_at, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id, created_at
+            """
+            now = datetime.now()
+            cursor.execute(query, (customer_name, amount, currency, "pending", payment_method, now, now), prepare=True)
+            payment_id, created_at = cursor.fetchone()
+            conn.commit()
+        load_payments.clear()
+        load_payment_stats.clear()
+        return {
+            "id": payment_id,
+            "customer_name": customer_name,
+            "amount": amount,
+            "currency": currency,
+            "status": "pending",
+            "payment_method": payment_method,
+            "created_at": created_at,
+        }
     except Exception as e:
-        st.error(f"Error fetching payments: {e}")
-        return []
+        st.error(f"Error adding payment: {e}")
+        return None
 
-def add_payment(conn, customer_name: str, amount: float, currency: str, 
-                payment_method: str) -> bool:
-    """Add a new payment to the database"""
-    if not conn:
-        return False
-    
+def add_payments_bulk(rows: List[Tuple[str, float, str, str]]) -> bool:
+    """Add many payments at once from (customer_name, amount, currency, payment_method) rows"""
     try:
-        cursor = conn.cursor()
-        query = """
-        INSERT INTO payments (customer_name, amount, currency, status, payment_method, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """
         now = datetime.now()
-        cursor.execute(query, (customer_name, amount, currency, "pending", payment_method, now, now))
-        conn.commit()
-        cursor.close()
+        records = [(customer_name, amount, currency, "pending", payment_method, now, now)
+                   for customer_name, amount, currency, payment_method in rows]
+        with get_conn() as conn, conn.cursor() as cursor:
+            if len(records) > BULK_COPY_THRESHOLD:
+                # COPY streams all rows in a single statement
+                with cursor.copy("""
+                COPY payments (customer_name, amount, currency, status, payment_method, created_at, updated_at)
+                FROM STDIN
+                """) as copy:
+                    for record in records:
+                        copy.write_row(record)
+            else:
+                query = """
+                INSERT INTO payments (customer_name, amount, currency, status, payment_method, created_at, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                """
+                cursor.executemany(query, records)
+            conn.commit()
+        load_payments.clear()
+        load_payment_stats.clear()
         return True
     except Exception as e:
-        st.error(f"Error adding payment: {e}")
+        st.error(f"Error adding payments: {e}")
         return False
 
-def update_payment_status(conn, payment_id: int, new_status: str) -> bool:
+def update_payment_status(payment_id: int, new_status: str) -> bool:
     """Update payment status"""
-    if not conn:
-        return False
-    
     try:
-        cursor = conn.cursor()
-        query = """
-        UPDATE payments 
-        SET status = %s, updated_at = %s 
-        WHERE id = %s
-        """
-        cursor.execute(query, (new_status, datetime.now(), payment_id))
-        conn.commit()
-        cursor.close()
+        with get_conn() as conn, conn.cursor() as cursor:
+            query = """
+            UPDATE payments 
+            SET status = %s, updated_at = %s 
+            WHERE id = %s
+            """
+            cursor.execute(query, (new_status, datetime.now(), payment_id), prepare=True)
+            conn.commit()
+        load_payments.clear()
+        load_payment_stats.clear()
         return True
     except Exception as e:
         st.error(f"Error updating payment: {e}")
         return False
 
-def get_payment_stats(conn) -> Dict[str, Any]:
-    """Get payment statistics"""
-    if not conn:
-        return {}
-    
-    try:
-        cursor = conn.cursor()
-        
-        # Total payments today
-        today = datetime.now().date()
-        cursor.execute("""
-            SELECT COUNT(*), COALESCE(SUM(amount), 0) 
-            FROM payments 
-            WHERE DATE(created_at) = %s
-        """, (today,))
-        today_count, today_total = cursor.fetchone()
-        
-        # Status distribution
-        cursor.execute("""
-            SELECT status, COUNT(*) 
-            FROM payments 
-            GROUP BY status
-        """)
-        status_dist = dict(cursor.fetchall())
-        
-        # Recent activity (last hour)
-        one_hour_ago = datetime.now() - timedelta(hours=1)
+@st.cache_data(ttl=NOTIFY_CACHE_TTL, max_entries=32, show_spinner=False)
+def load_payment_stats(epoch: int = 0) -> Dict[str, Any]:
+    """Query payment statistics; errors propagate so a failure is never cached"""
+    # epoch only keys the cache; see cache_epoch
+    with get_conn() as conn, conn.cursor() as cursor:
+        # Today's totals, recent activity and status distribution in one pass.
+        # Today is a half-open range on created_at rather than DATE(created_at)
+        # so the predicate stays sargable.
+        today_start = datetime.combine(date.today(), dt_time.min)
+        today_end = today_start + timedelta(days=1)
         cursor.execute("""
-            SELECT COUNT(*) 
-            FROM payments 
-            WHERE created_at >= %s
-        """, (one_hour_ago,))
-        recent_count = cursor.fetchone()[0]
-        
-        cursor.close()
-        
-        return {
-            "today_count": today_count or 0,
-            "today_total": float(today_total or 0),
-            "status_distribution": status_dist,
-            "recent_activity": recent_count or 0
-        }
-    except Exception as e:
-        st.error(f"Error fetching stats: {e}")
-        return {}
+            SELECT
+                COUNT(*) FILTER (WHERE created_at >= %s AND created_at < %s),
+                COALESCE(SUM(amount) FILTER (WHERE created_at >= %s AND created_at < %s), 0),
+                COUNT(*) FILTER (WHERE created_at >= NOW() - INTERVAL '1 hour'),
+                COUNT(*) FILTER (WHERE status = 'pending'),
+                COUNT(*) FILTER (WHERE status = 'completed'),
+                COUNT(*) FILTER (WHERE status = 'failed'),
+                COUNT(*) FILTER (WHERE status = 'refunded')
+            FROM payments
+        """, (today_start, today_end, today_start, today_end), prepare=True)
+        (today_count, today_total, recent_count,
+         pending, completed, failed, refunded) = cursor.fetchone()
+    status_dist = {
+        "pending": pending,
+        "completed": completed,
+        "failed": failed,
+        "refunded": refunded,
+    }
+    
+    return {
+        "today_count": today_count or 0,
+        "today_total": float(today_total or 0),
+        "status_distribution": status_dist,
+        "recent_activity": recent_count or 0
+    }
 
-# Main app
-def main():
-    st.title("💳 Payment Tracker")
-    st.markdown("Real-time payment monitoring and management")
+class PaymentListener:
+    """LISTEN on payments_ch in a background thread and clear cached reads on each notification"""
     
-    # Initialize database connection
-    conn = init_connection()
+    def __init__(self, host: str):
+        self.host = host
+        # Set once LISTEN works and the notify trigger exists
+        self.confirmed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
     
-    if not conn:
-        st.error("Unable to connect to database. Please check your Neon configuration.")
-        st.info("Make sure to set the following environment variables:")
-        st.code("""
-        NEON_HOST=your-neon-host
-        NEON_DATABASE=your-database-name
-        NEON_USER=your-username
-        NEON_PASSWORD=your-password
-        NEON_PORT=5432
-        """)
-        return
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                logger.warning("payments_ch listener failed; retrying in 5s", exc_info=True)
+            self.confirmed = False
+            time.sleep(5)
     
-    # Sidebar for controls
-    with st.sidebar:
-        st.header("Controls")
-        
-        # Auto-refresh toggle
-        auto_refresh = st.checkbox("Auto Refresh", value=True)
-        if auto_refresh:
-            refresh_interval = st.slider("Refresh Interval (seconds)", 5, 60, 10)
-        
-        st.divider()
-        
-        # Add new payment form
-        st.subheader("Add New Payment")
-        with st.form("add_payment"):
-            customer_name = st.text_input("Customer Name")
-            amount = st.number_input("Amount", min_value=0.01, step=0.01)
-            currency = st.selectbox("Currency", ["USD", "EUR", "GBP", "JPY"])
-            payment_method = st.selectbox("Payment Method", 
-                                        ["credit_card", "debit_card", "paypal", "bank_transfer"])
-            
-            if st.form_submit_button("Add Payment"):
-                if customer_name and amount > 0:
-                    if add_payment(conn, customer_name, amount, currency, payment_method):
-                        st.success("Payment added successfully!")
-                        st.rerun()
-                    else:
-                        st.error("Failed to add payment")
-                else:
-                    st.error("Please fill in all required fields")
+    def listen(self):
+        with psycopg.connect(**{**connection_kwargs(), "host": self.host},
+                             autocommit=True) as conn:
+            conn.execute("LISTEN payments_ch")
+            has_trigger = conn.execute("""
+                SELECT 1 FROM pg_trigger
+                WHERE tgrelid = 'payments'::regclass AND tgname = 'payments_notify'
+            """).fetchone() is not None
+            if not has_trigger:
+                logger.warning("payments_notify trigger is not installed; "
+                               "cached reads will expire every %ss", CACHE_TTL)
+            # Our own notification proves delivery works on this connection
+            conn.execute("NOTIFY payments_ch, 'listener_ready'")
+            for notify in conn.notifies():
+                if notify.payload == "listener_ready":
+                    self.confirmed = has_trigger
+                # Also clears on confirmation, since changes may have been
+                # missed while the listener was down
+                load_payments.clear()
+                load_payment_stats.clear()
+
+@st.cache_resource
+def start_payment_listener() -> PaymentListener:
+    """Start the payments_ch listener once per server process"""
+    # PgBouncer (Neon's -pooler endpoint) does not deliver LISTEN/NOTIFY;
+    # listen on the direct endpoint for the same database instead
+    host = (CFG.host or "").replace("-pooler", "", 1)
+    listener = PaymentListener(host)
+    listener.thread.start()
+    return listener
+
+def cache_epoch() -> int:
+    """Cache key part that rolls over every CACHE_TTL seconds until notifications are confirmed"""
+    if start_payment_listener().confirmed:
+        return 0
+    return int(time.time() // CACHE_TTL)
+
+def fetch_dashboard_data(limit: int, before: Optional[Tuple[datetime, int]] = None):
+    """Fetch stats and a page of payments concurrently on separate pooled connections"""
+    epoch = cache_epoch()
+    # Worker threads need the script run context to use st.cache_data
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx,
+                            initargs=(None, ctx)) as executor:
+        stats_future = executor.submit(load_payment_stats, epoch)
+        payments_future = executor.submit(load_payments, limit, before, epoch)
+    
+    # Errors are reported here, on the script thread, so st.error renders in
+    # the caller's container (the dashboard fragment) rather than the page root
+    try:
+        stats = stats_future.result()
+    except Exception as e:
+        st.error(f"Error fetching stats: {e}")
+        stats = {}
     
-    # Main content area
+    try:
+        payments = payments_future.result()
+    except Exception as e:
+        st.error(f"Error fetching payments: {e}")
+        payments = pd.DataFrame()
+    
+    return stats, payments
+
+def render_dashboard():
+    """Render the stats, status chart and recent payments table"""
     col1, col2, col3, col4 = st.columns(4)
     
-    # Get statistics
-    stats = get_payment_stats(conn)
+    # Get statistics and the current page of payments
+    page_size = 50
+    page_cursor = st.session_state.get("page_cursor")
+    stats, payments = fetch_dashboard_data(page_size, page_cursor)
     
     with col1:
         st.metric("Today's Payments", stats.get("today_count", 0))
@@ -216,25 +355,32 @@ def main():
     # Payment status distribution
     if stats.get("status_distribution"):
         st.subheader("Payment Status Distribution")
-        status_df = pd.DataFrame(
-            list(stats["status_distribution"].items()),
-            columns=["Status", "Count"]
+        status_dist = stats["status_distribution"]
+        st.bar_chart(
+            {"Status": list(status_dist), "Count": list(status_dist.values())},
+            x="Status",
+            y="Count",
         )
-        st.bar_chart(status_df.set_index("Status"))
     
     st.divider()
     
     # Recent payments table
     st.subheader("Recent Payments")
     
-    payments = get_payments(conn, 50)
+    # The next page starts after the last row of this one
+    next_cursor = None
+    if len(payments) == page_size:
+        last_row = payments.iloc[-1]
+        next_cursor = (last_row['created_at'].to_pydatetime(), int(last_row['id']))
     
-    if payments:
-        df = pd.DataFrame(payments)
+    if not payments.empty:
+        df = payments
         
         # Format the dataframe for better display
-        df['created_at'] = pd.to_datetime(df['created_at']).dt.strftime('%Y-%m-%d %H:%M:%S')
-        df['amount'] = df['amount'].apply(lambda x: f"${float(x):.2f}")
+        # created_at already arrives as datetimes from the driver
+        df['created_at'] = df['created_at'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        amounts = pd.to_numeric(df['amount'], errors='coerce').to_numpy(dtype="float64", na_value=np.nan)
+        df['amount'] = np.char.add('$', np.char.mod('%.2f', amounts))
         
         # Display the table
         st.dataframe(
@@ -260,26 +406,105 @@ def main():
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            payment_id = st.selectbox("Select Payment ID", [p['id'] for p in payments])
+            payment_id = st.number_input("Payment ID", min_value=1, step=1)
         
         with col2:
             new_status = st.selectbox("New Status", ["pending", "completed", "failed", "refunded"])
         
         with col3:
             if st.button("Update Status"):
-                if update_payment_status(conn, payment_id, new_status):
+                if payment_id not in set(df['id']):
+                    st.error("Payment ID is not in the recent payments table")
+                elif update_payment_status(payment_id, new_status):
                     st.success("Status updated successfully!")
-                    st.rerun()
+                    st.rerun(scope="fragment")
                 else:
                     st.error("Failed to update status")
     
-    else:
+    elif page_cursor is None:
         st.info("No payments found. Add some payments to get started!")
+    else:
+        st.info("No older payments.")
+    
+    # Page navigation
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        if st.button("Newest", disabled=page_cursor is None):
+            st.session_state["page_cursor"] = None
+            st.rerun(scope="fragment")
+    
+    with col2:
+        if st.button("Next", disabled=next_cursor is None):
+            st.session_state["page_cursor"] = next_cursor
+            st.rerun(scope="fragment")
+
+# Main app
+def main():
+    st.title("💳 Payment Tracker")
+    st.markdown("Real-time payment monitoring and management")
+    
+    # Initialize database connection pool
+    if not get_pool():
+        st.error("Unable to connect to database. Please check your Neon configuration.")
+        st.info("Make sure to set the following environment variables:")
+        st.code("""
+        NEON_HOST=your-neon-host
+        NEON_DATABASE=your-database-name
+        NEON_USER=your-username
+        NEON_PASSWORD=your-password
+        NEON_PORT=5432
+        """)
+        return
+    
+    # Refresh cached data as soon as payments change, not only on TTL expiry
+    start_payment_listener()
+    
+    # Sidebar for controls
+    with st.sidebar:
+        st.header("Controls")
+        
+        # Auto-refresh toggle
+        auto_refresh = st.checkbox("Auto Refresh", value=True)
+        if auto_refresh:
+            refresh_interval = st.slider("Refresh Interval (seconds)", 5, 60, 10)
+        
+        st.divider()
+        
+        # Add new payment form
+        st.subheader("Add New Payment")
+        with st.form("add_payment"):
+            customer_name = st.text_input("Customer Name")
+            amount = st.number_input("Amount", min_value=0.01, step=0.01)
+            currency = st.selectbox("Currency", ["USD", "EUR", "GBP", "JPY"])
+            payment_method = st.selectbox("Payment Method", 
+                                        ["credit_card", "debit_card", "paypal", "bank_transfer"])
+            
+            if st.form_submit_button("Add Payment"):
+                if customer_name and amount > 0:
+                    new_payment = add_payment(customer_name, amount, currency, payment_method)
+                    if new_payment:
+                        st.success(f"Payment #{new_payment['id']} added successfully!")
+                    else:
+                        st.error("Failed to add payment")
+                else:
+                    st.error("Please fill in all required fields")
+        
+        st.divider()
+        
+        # Export all payments
+        st.subheader("Export Payments")
+        if st.button("Prepare CSV Export"):
+            try:
+                st.download_button("Download payments.csv", export_payments_csv(),
+                                   file_name="payments.csv", mime="text/csv")
+            except Exception as e:
+                st.error(f"Error exporting payments: {e}")
     
-    # Auto-refresh functionality
-    if auto_refresh:
-        time.sleep(refresh_interval)
-        st.rerun()
+    # Recent data refreshes in a fragment so the title, sidebar and form
+    # are not rebuilt on every tick
+    run_every = refresh_interval if auto_refresh else None
+    st.fragment(run_every=run_every)(render_dashboard)()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,23 @@
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+# Imported modules are cached in sys.modules, so unlike app.py (which
+# Streamlit re-executes on every rerun) this is evaluated once per process
+
+@dataclass(frozen=True, slots=True)
+class DBConfig:
+    """Neon connection settings"""
+    host: Optional[str]
+    database: Optional[str]
+    user: Optional[str]
+    password: Optional[str]
+    port: str
+
+CFG = DBConfig(
+    host=os.getenv("NEON_HOST"),
+    database=os.getenv("NEON_DATABASE"),
+    user=os.getenv("NEON_USER"),
+    password=os.getenv("NEON_PASSWORD"),
+    port=os.getenv("NEON_PORT", "5432"),
+)